@@ -1,13 +1,50 @@
 """# Download button manager"""
 
 from .download_btn_mixin import DownloadBtnMixin
-
-from flask import Blueprint, Response, request, session
+from .jobs import Channel, CreateFilesJob
+
+from flask import (
+    Blueprint, Response, abort, has_request_context, render_template, 
+    request, send_file, session, url_for
+)
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import inspect
+
+from collections import OrderedDict
+from inspect import signature
+from urllib.parse import quote
+import hashlib
+import hmac
+import mimetypes
+import os
+import threading
+import time
+import unicodedata
+
+# `attachment_filename` was renamed `download_name` in Flask 2.0
+SEND_FILE_NAME = (
+    'download_name' if 'download_name' in signature(send_file).parameters 
+    else 'attachment_filename'
+)
 
 default_settings = {
     'db': None,
     'btn_template': 'download_btn/button.html',
     'progress_template': 'download_btn/progress.html',
+    'batch_template': 'download_btn/batch.html',
+    'prefetch_budget': 10,
+    'prefetch_max_age': 300,
+    'profile': False,
+    'max_memory': None,
+    'profile_report_budget': 100,
+    'storage': None,
+    'sendfile': None,
+    'sendfile_prefix': '/protected/',
+    'url_expires': 3600,
+    'multiplex': False,
+    'channel_timeout': 60,
+    'multiplex_timeout': 30,
+    'release_db_connections': False,
 }
 
 
@@ -38,6 +75,98 @@ class DownloadBtnManager():
     progress_template : str, default='download_btn/progress.html'
         Path to the default progress bar template.
 
+    batch_template : str, default='download_btn/batch.html'
+        Path to the template used by `render_btns`.
+
+    prefetch_budget : int, default=10
+        Maximum number of prefetched file creation jobs which have not been 
+        claimed by a click. When the budget is exceeded, the oldest unclaimed 
+        job is cancelled and discarded. A cancelled job stops before its next 
+        step, but a step already in progress runs to completion. Set to 0 to 
+        disable prefetching.
+
+    prefetch_max_age : int, default=300
+        Number of seconds for which a prefetched job can be claimed by a 
+        click. Older jobs are discarded and a fresh job is started instead, 
+        so clients do not receive stale files. When `storage` is set, the 
+        maximum age is capped at `url_expires`, because the signed URLs of 
+        an older job's files may have expired.
+
+    profile : bool, default=False
+        Debug mode. If `True`, each create file function runs under 
+        `cProfile` and `tracemalloc`, and a report is stored for each job. 
+        See `get_profile_report`. Only one create file function is profiled 
+        with `cProfile` at a time, because on Python 3.12 and later the 
+        profiler is active for the whole process. Functions which run while 
+        another is profiled report timing and memory without statistics.
+
+    max_memory : int or None, default=None
+        Ceiling in bytes on the memory traced by `tracemalloc` across the 
+        whole process, not per job. If it is exceeded while a job runs, the 
+        job is aborted and the client receives a `create_error` event. The 
+        peak is checked each time a create file function yields an event. 
+        When jobs run concurrently, the job which observes the breach is 
+        aborted, whichever job made the allocations.
+
+    profile_report_budget : int, default=100
+        Maximum number of profile reports kept. When the budget is exceeded, 
+        the oldest report is discarded.
+
+    storage : flask_download_btn.storage.Storage or None, default=None
+        Storage backend into which create file functions can write files. 
+        See `DownloadBtnMixin.store_file`.
+
+    sendfile : str or None, default=None
+        Header used to hand stored files off to the front-end web server. 
+        `'X-Sendfile'` (Apache, lighttpd) sends the file's absolute path. 
+        `'X-Accel-Redirect'` (nginx) sends `sendfile_prefix` followed by the 
+        file's storage key. If `None`, Flask serves the file.
+
+    sendfile_prefix : str, default='/protected/'
+        Internal location of the storage directory for `X-Accel-Redirect`.
+
+    url_expires : int, default=3600
+        Number of seconds for which signed URLs to stored files are valid. 
+        Stored files are deleted after their URLs expire; expired files are 
+        cleaned up when new files are stored.
+
+    multiplex : bool, default=False
+        If `True`, all download buttons on a page share one server sent 
+        event connection instead of opening one connection per button. 
+        Channels are bound to the session; requests for a channel issued to 
+        another session are rejected.
+
+        Channels live in the memory of the server process which created 
+        them. Multiplexing requires a single server process, or sticky 
+        routing which sends every request from a session to the same 
+        process. Otherwise a button's events may be queued in a process 
+        which is not streaming its channel. See `multiplex_timeout`.
+
+    channel_timeout : int, default=60
+        Number of seconds after which a multiplexed channel with no 
+        connected client is discarded.
+
+    multiplex_timeout : int, default=30
+        Number of seconds a multiplexed button waits for an event from its 
+        channel. If no event arrives in time, the button falls back to its 
+        own server sent event connection, or shows an error if file 
+        creation had already reported progress. Set this above the longest 
+        gap between the events of your create file functions.
+
+    release_db_connections : bool, default=False
+        If `True`, file creation closes the database session each time a 
+        create file function yields an event, so pooled connections are not 
+        held while the function sleeps or computes. The button is added back 
+        to the session before the function resumes. This changes what create 
+        file functions may rely on:
+
+        - Other ORM objects are detached at every yield. Re-add them with 
+        `db.session.add` after the yield before using them, or accessing 
+        their lazy attributes raises `DetachedInstanceError`.
+        - Changes must be committed before yielding. Changes which were only 
+        flushed, e.g. by autoflush, are rolled back when the session closes 
+        and are lost without an error.
+
     Notes
     -----
     If `app` and `db` are not set on initialization, they must be set using 
@@ -93,6 +222,16 @@ class DownloadBtnManager():
         settings = default_settings.copy()
         settings.update(kwargs)
         [setattr(self, key, val) for key, val in settings.items()]
+        # maps (button class name, button id) to prefetched jobs
+        self._prefetch_jobs = OrderedDict()
+        self._prefetch_lock = threading.Lock()
+        # maps button model ids to profile reports of their latest job
+        self._profile_reports = OrderedDict()
+        # time at which expired files were last deleted from storage
+        self._storage_cleaned = 0
+        # maps channel ids to multiplexed channels
+        self._channels = {}
+        self._channels_lock = threading.Lock()
         if app is not None:
             self._init_app(app)
     
@@ -140,9 +279,15 @@ class DownloadBtnManager():
         def create_files(id, btn_cls):
             """File creation"""
             btn = self._get_btn(id, btn_cls)
-            return Response(
-                btn._create_files(app), mimetype='text/event-stream'
-            )
+            job = self._claim_prefetch(id, btn_cls)
+            events = btn._create_files(app) if job is None else job.stream()
+            return Response(events, mimetype='text/event-stream')
+
+        @bp.route('/download-btn/prefetch/<id>/<btn_cls>', methods=['POST'])
+        def prefetch(id, btn_cls):
+            """Speculative file creation before the button is clicked"""
+            self.prefetch(self._get_btn(id, btn_cls))
+            return ''
 
         @bp.route('/download-btn/downloaded/<id>/<btn_cls>', methods=['POST'])
         def downloaded(id, btn_cls):
@@ -152,13 +297,389 @@ class DownloadBtnManager():
             self.db.session.commit()
             return ''
 
+        @bp.route(
+            '/download-btn/multiplex/start/<id>/<btn_cls>', methods=['POST']
+        )
+        def multiplex_start(id, btn_cls):
+            """File creation with events sent over a page-level channel"""
+            btn = self._get_btn(id, btn_cls)
+            job = self._claim_prefetch(id, btn_cls)
+            if job is None:
+                job = CreateFilesJob(app, type(btn), id).start()
+            channel_id = self._check_channel(request.form.get('channel'))
+            self._get_channel(channel_id).add(job, btn.model_id)
+            return ''
+
+        @bp.route('/download-btn/multiplex')
+        def multiplex():
+            """Page-level stream of events for all buttons"""
+            channel_id = self._check_channel(request.args.get('channel'))
+            channel = self._get_channel(channel_id)
+            return Response(channel.stream(), mimetype='text/event-stream')
+
+        @bp.route('/download-btn/file/<token>')
+        def download_file(token):
+            """Serve a stored file from a signed URL"""
+            try:
+                key, filename = self._serializer().loads(
+                    token, max_age=self.url_expires
+                )
+            except BadSignature:
+                abort(403)
+            if self.sendfile is None:
+                return send_file(
+                    self.storage.path(key), 
+                    as_attachment=True, 
+                    **{SEND_FILE_NAME: filename}
+                )
+            if self.sendfile == 'X-Accel-Redirect':
+                location = self.sendfile_prefix + key
+            else:
+                location = self.storage.path(key)
+            resp = Response(mimetype=(
+                mimetypes.guess_type(filename)[0] 
+                or 'application/octet-stream'
+            ))
+            resp.headers[self.sendfile] = location
+            resp.headers.add(
+                'Content-Disposition', 'attachment', 
+                **self._filename_options(filename)
+            )
+            return resp
+
         app.register_blueprint(bp)
 
+    def file_url(self, key, filename):
+        """
+        Get a signed, expiring URL for a stored file.
+
+        Parameters
+        ----------
+        key : str
+            Key identifying the file in storage.
+
+        filename : str
+            Name of the downloaded file.
+
+        Returns
+        -------
+        url : str
+        """
+        token = self._serializer().dumps([key, filename])
+        if has_request_context():
+            return url_for('download_btn.download_file', token=token)
+        # file creation streams run outside of the request context
+        adapter = self.app.url_map.bind(
+            '', script_name=self.app.config['APPLICATION_ROOT']
+        )
+        return adapter.build('download_btn.download_file', {'token': token})
+
+    def _filename_options(self, filename):
+        """
+        Content-Disposition filename options. Werkzeug quotes the values. 
+        Non-ASCII filenames get an ASCII fallback and an RFC 5987 
+        `filename*` option.
+        """
+        try:
+            filename.encode('ascii')
+        except UnicodeEncodeError:
+            simple = unicodedata.normalize('NFKD', filename)
+            return {
+                'filename': simple.encode('ascii', 'ignore').decode(),
+                'filename*': "UTF-8''" + quote(filename, safe='')
+            }
+        return {'filename': filename}
+
+    def _clean_storage(self):
+        """
+        Delete stored files whose signed URLs have expired. Cleaning runs at 
+        most once per `url_expires` seconds. Cleaning failures are logged 
+        rather than raised, so they do not abort file creation.
+        """
+        now = time.time()
+        if now - self._storage_cleaned < self.url_expires:
+            return
+        self._storage_cleaned = now
+        try:
+            self.storage.clean(self.url_expires)
+        except Exception:
+            self.app.logger.exception('Cleaning download storage failed')
+
+    def _serializer(self):
+        return URLSafeTimedSerializer(
+            self.app.secret_key, salt='download-btn-file'
+        )
+
+    def create_btns(self, btn_cls, kwargs_list):
+        """
+        Create download buttons in a single database flush and commit.
+
+        Parameters
+        ----------
+        btn_cls : class
+            Class of the download buttons.
+
+        kwargs_list : list of dict or int
+            Keyword arguments for each button. If an int, that many buttons 
+            are created with default arguments.
+
+        Returns
+        -------
+        btns : list of btn_cls
+            Committed download buttons.
+
+        Examples
+        --------
+        ```python
+        btns = download_btn_manager.create_btns(
+        \    DownloadBtn, [{'downloads': [(url, name)]} for url, name in files]
+        )
+        ```
+        """
+        if isinstance(kwargs_list, int):
+            kwargs_list = [{}] * kwargs_list
+        btns = [btn_cls(**kwargs) for kwargs in kwargs_list]
+        self.db.session.add_all(btns)
+        self.db.session.commit()
+        return btns
+
+    def render_btns(self, btns, btn=True, progress=True, script=True):
+        """
+        Render the buttons, progress bars, and scripts of many download 
+        buttons in one template pass.
+
+        Rather than storing one CSRF token per button in the session, the 
+        session stores a single batch key. Each button's token is an HMAC of 
+        its model id under the application's secret key and the batch key, 
+        so the session cookie does not grow with the number of buttons. 
+        Call `clear_batch_csrf` to revoke the tokens of every button 
+        rendered this way.
+
+        At most `prefetch_budget` buttons with `prefetch='render'` are 
+        prefetched, the first in order. Prefetching more would only cancel 
+        the earlier jobs, so the remaining buttons create their files when 
+        clicked.
+
+        Parameters
+        ----------
+        btns : list of DownloadBtnMixin
+            Download buttons.
+
+        btn : bool, default=True
+            Indicates that the download buttons are rendered.
+
+        progress : bool, default=True
+            Indicates that the progress bars are rendered.
+
+        script : bool, default=True
+            Indicates that the download button scripts are rendered. Scripts 
+            require jQuery to be loaded before them.
+
+        Returns
+        -------
+        markup : flask.Markup
+            Rendered html for each button, in order. Insert this into a 
+            `<body>` tag in a Jinja template.
+        """
+        batch_key = self._batch_key() if script else None
+        items, n_prefetched = [], 0
+        for download_btn in btns:
+            csrf_token = None
+            if script:
+                csrf_token = self._batch_csrf_token(batch_key, download_btn)
+                if (
+                    download_btn.prefetch == 'render' 
+                    and n_prefetched < self.prefetch_budget
+                    and self.prefetch(download_btn) is not None
+                ):
+                    n_prefetched += 1
+            items.append(
+                (download_btn, download_btn._btn_kwargs(csrf_token))
+            )
+        return render_template(
+            self.batch_template,
+            items=items,
+            render_btn=btn,
+            render_progress=progress,
+            render_script=script,
+            multiplex=self.multiplex,
+            multiplex_timeout=self.multiplex_timeout,
+            channel_token=(
+                self._channel_token() if script and self.multiplex else None
+            )
+        )
+
+    def clear_batch_csrf(self):
+        """
+        Revoke client permission to download the files of every button 
+        rendered with `render_btns` in this session.
+
+        Returns
+        -------
+        batch key : str or None
+        """
+        return session.pop('download-btn-batch-key', None)
+
+    def _batch_key(self):
+        """Get the session's batch key, creating it if necessary"""
+        batch_key = session.get('download-btn-batch-key')
+        if batch_key is None:
+            batch_key = session['download-btn-batch-key'] = (
+                os.urandom(16).hex()
+            )
+        return batch_key
+
+    def _batch_csrf_token(self, batch_key, btn):
+        """CSRF token for a button rendered with `render_btns`"""
+        secret_key = self.app.secret_key
+        if isinstance(secret_key, str):
+            secret_key = secret_key.encode()
+        msg = (batch_key + '.' + btn.model_id).encode()
+        return 'batch-' + hmac.new(secret_key, msg, hashlib.sha256).hexdigest()
+
+    def prefetch(self, btn):
+        """
+        Start creating the button's files in the background before it is 
+        clicked. When the button is clicked, the client attaches to the 
+        running or finished job instead of starting a new one.
+
+        Only buttons without `handle_form_functions` are prefetched, because 
+        their files cannot depend on a form response. Calling this method 
+        while a prefetched job for the button is outstanding has no effect, 
+        unless the job is older than `prefetch_max_age`.
+
+        Parameters
+        ----------
+        btn : DownloadBtnMixin
+            Download button whose files should be prefetched.
+
+        Returns
+        -------
+        job : flask_download_btn.jobs.CreateFilesJob or None
+            The prefetched job, or `None` if the button cannot be prefetched.
+        """
+        if btn.handle_form_functions or self.prefetch_budget <= 0:
+            return None
+        id = inspect(btn).identity[0]
+        key = (type(btn).__name__, str(id))
+        with self._prefetch_lock:
+            job = self._prefetch_jobs.get(key)
+            if job is not None:
+                if not self._prefetch_expired(job):
+                    return job
+                del self._prefetch_jobs[key]
+                job.cancel()
+            job = CreateFilesJob(self.app, type(btn), id)
+            self._prefetch_jobs[key] = job
+            while len(self._prefetch_jobs) > self.prefetch_budget:
+                _, discarded = self._prefetch_jobs.popitem(last=False)
+                discarded.cancel()
+        return job.start()
+
+    def get_profile_report(self, btn):
+        """
+        Get the profile report of the button's latest file creation job. 
+        Reports are stored when `profile` or `max_memory` is set.
+
+        Parameters
+        ----------
+        btn : DownloadBtnMixin
+            Download button.
+
+        Returns
+        -------
+        report : list of dict or None
+            Report for each create file function. See 
+            `flask_download_btn.profiling.JobProfiler`.
+        """
+        return self._profile_reports.get(btn.model_id)
+
+    def _store_profile(self, btn, profiler):
+        """Store and log the profile report of a file creation job"""
+        self._profile_reports.pop(btn.model_id, None)
+        self._profile_reports[btn.model_id] = profiler.reports
+        while len(self._profile_reports) > self.profile_report_budget:
+            self._profile_reports.popitem(last=False)
+        self.app.logger.info(
+            'Profile of {}\n{}'.format(btn.model_id, profiler.format_report())
+        )
+
+    def _channel_token(self):
+        """
+        Issue a token for a new multiplexed channel. The token is a random 
+        page id signed with a secret stored in the session, so only the 
+        session to which it was issued can use it.
+        """
+        secret = session.get('download-btn-channel-key')
+        if secret is None:
+            secret = session['download-btn-channel-key'] = os.urandom(16).hex()
+        page_id = os.urandom(16).hex()
+        return page_id + '.' + self._sign_channel(secret, page_id)
+
+    def _check_channel(self, token):
+        """
+        Return the channel token if it was issued to the caller's session. 
+        Otherwise abort with 403.
+        """
+        secret = session.get('download-btn-channel-key')
+        page_id, _, signature = (token or '').partition('.')
+        if secret is None or not hmac.compare_digest(
+                signature, self._sign_channel(secret, page_id)
+            ):
+            abort(403)
+        return token
+
+    def _sign_channel(self, secret, page_id):
+        return hmac.new(
+            secret.encode(), page_id.encode(), hashlib.sha256
+        ).hexdigest()
+
+    def _get_channel(self, channel_id):
+        """
+        Get or create a multiplexed channel. Channels without a connected 
+        client for longer than `channel_timeout` are discarded.
+        """
+        with self._channels_lock:
+            cutoff = time.time() - self.channel_timeout
+            self._channels = {
+                key: channel for key, channel in self._channels.items()
+                if channel.connected or channel.last_active > cutoff
+            }
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                channel = self._channels[channel_id] = Channel()
+            channel.last_active = time.time()
+            return channel
+
+    def _claim_prefetch(self, id, btn_cls):
+        """
+        Remove and return the prefetched job for a button, or `None` if 
+        there is no usable prefetched job.
+        """
+        with self._prefetch_lock:
+            job = self._prefetch_jobs.pop((btn_cls, str(id)), None)
+        if job is None or job.cancelled:
+            return None
+        if self._prefetch_expired(job):
+            job.cancel()
+            return None
+        return job
+
+    def _prefetch_expired(self, job):
+        """
+        Indicates that a prefetched job is older than `prefetch_max_age`, or 
+        `url_expires` when files are stored.
+        """
+        max_age = self.prefetch_max_age
+        if self.storage is not None:
+            max_age = min(max_age, self.url_expires)
+        return time.time() - job.created > max_age
+
     def _get_btn(self, id, btn_cls):
         """
         Get a download button. This method prevents CSRF by checking that the 
         CSRF token sent with the request matches the CSRF token stored in the 
-        session.
+        session, or the button's token derived from the session's batch key.
 
         Parameters
         ----------
@@ -174,6 +695,13 @@ class DownloadBtnManager():
             Button of type `btn_cls` with the identity `id`.
         """
         btn = self._registered_classes[btn_cls].query.get(id)
-        if session[btn.get_id('csrf')] == request.args.get('csrf_token'):
-            return btn
+        csrf_token = request.args.get('csrf_token')
+        if csrf_token is not None:
+            if session.get(btn.get_id('csrf')) == csrf_token:
+                return btn
+            batch_key = session.get('download-btn-batch-key')
+            if batch_key is not None and hmac.compare_digest(
+                    csrf_token, self._batch_csrf_token(batch_key, btn)
+                ):
+                return btn
         raise ValueError('CSRF attempt detected and blocked')
\ No newline at end of file
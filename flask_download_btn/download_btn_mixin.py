@@ -1,5 +1,7 @@
 """# Download button mixin"""
 
+from .profiling import JobProfiler, MemoryLimitError
+
 from flask import current_app, render_template, session
 from sqlalchemy import Boolean, Column, Integer, String, Text, inspect
 from sqlalchemy_modelid import ModelIdBase
@@ -74,6 +76,13 @@ class DownloadBtnMixin(ModelIdBase):
         as `None`. If there are multiple forms on the page, set `form_id` to 
         the ID of the form associated with the download button.
 
+    prefetch : str or None, default=None
+        When to start creating files in the background before the button is 
+        clicked. `'render'` starts when the script is rendered, `'hover'` 
+        starts when the client hovers over or focuses the button. If `None`, 
+        files are created after the button is clicked. Buttons with 
+        `handle_form_functions` are never prefetched.
+
     Additional attributes
     ---------------------
     progress_text : str, default=''
@@ -102,6 +111,7 @@ class DownloadBtnMixin(ModelIdBase):
     download_msg = Column(Text)
     downloaded = Column(Boolean, default=False)
     form_id = Column(String)
+    prefetch = Column(String)
 
     @property
     def _form(self):
@@ -181,6 +191,7 @@ class DownloadBtnMixin(ModelIdBase):
             downloads=[],
             download_msg='',
             form_id=None,
+            prefetch=None,
             **kwargs
         ):
         manager = current_app.extensions['download_btn_manager']
@@ -201,6 +212,7 @@ class DownloadBtnMixin(ModelIdBase):
         self.tmp_downloads = []
         self.download_msg = download_msg
         self.form_id = form_id
+        self.prefetch = prefetch
         super().__init__(**kwargs)
 
     def get_id(self, sfx):
@@ -260,7 +272,8 @@ class DownloadBtnMixin(ModelIdBase):
         
         The script will call routes for form handling, file creation, and 
         download. Authentication for these routes requires a CSRF token. 
-        This method creates a unique token and stores it in the session.
+        This method creates a unique token and stores it in the session. If 
+        `prefetch` is `'render'`, file creation starts in the background.
 
         Returns
         -------
@@ -268,21 +281,38 @@ class DownloadBtnMixin(ModelIdBase):
             Rendered download button javascript. Insert this into a 
             `<head>` tag in a Jinja template.
         """
-        chars = string.ascii_letters + string.digits
-        csrf_token = ''.join([choice(chars) for i in range(90)])
+        csrf_token = self._new_csrf_token()
         session[self.get_id('csrf')] = csrf_token
-        btn_kwargs = {
+        manager = current_app.extensions['download_btn_manager']
+        if self.prefetch == 'render':
+            manager.prefetch(self)
+        return render_template(
+            'download_btn/script.html', 
+            btn=self, 
+            btn_kwargs=self._btn_kwargs(csrf_token), 
+            multiplex=manager.multiplex,
+            multiplex_timeout=manager.multiplex_timeout,
+            channel_token=(
+                manager._channel_token() if manager.multiplex else None
+            )
+        )
+
+    def _new_csrf_token(self):
+        """Create a random CSRF token"""
+        chars = string.ascii_letters + string.digits
+        return ''.join([choice(chars) for i in range(90)])
+
+    def _btn_kwargs(self, csrf_token):
+        """Keyword arguments for the download button routes' URLs"""
+        return {
             'id': inspect(self).identity[0],
             'btn_cls': type(self).__name__,
             'csrf_token': csrf_token
         }
-        return render_template(
-            'download_btn/script.html', btn=self, btn_kwargs=btn_kwargs
-        )
 
     def clear_csrf(self):
         """
-        Clear CSRF token from session. Call this method to revoke client permission to download the file.
+        Clear CSRF token from session. Call this method to revoke client permission to download the file. Buttons rendered with the manager's `render_btns` are revoked with `clear_batch_csrf`.
         
         Returns
         -------
@@ -367,6 +397,64 @@ class DownloadBtnMixin(ModelIdBase):
         data = json.dumps({'speed': speed})
         return 'event: transition_speed\ndata: {}\n\n'.format(data)
 
+    def error(self, text):
+        """
+        Report that file creation failed. The client displays the message 
+        and re-enables the button without downloading.
+
+        Parameters
+        ----------
+        text : str
+            Error message.
+
+        Returns
+        -------
+        error event : str
+            Server sent event to report the error.
+        """
+        data = json.dumps({'text': text})
+        return 'event: create_error\ndata: {}\n\n'.format(data)
+
+    def store_file(self, data, filename):
+        """
+        Write a file into the download button manager's storage backend and 
+        add it to the button's temporary downloads. The file is served from 
+        a signed, expiring URL.
+
+        Parameters
+        ----------
+        data : bytes, str, or file-like
+            File contents.
+
+        filename : str
+            Name of the downloaded file.
+
+        Returns
+        -------
+        url : str
+            Signed URL of the stored file.
+
+        Examples
+        --------
+        ```python
+        def create_file(btn):
+        \    yield btn.reset('Creating file', 0)
+        \    btn.store_file('Hello, World!', 'hello_world.txt')
+        \    yield btn.report('Creating file', 100)
+        ```
+        """
+        manager = current_app.extensions['download_btn_manager']
+        if manager.storage is None:
+            raise ValueError('Download button manager has no storage backend')
+        manager._clean_storage()
+        key = manager.storage.save(data, filename)
+        url = manager.file_url(key, filename)
+        tmp_downloads = getattr(self, 'tmp_downloads', None) or []
+        if not isinstance(tmp_downloads, list):
+            tmp_downloads = [tmp_downloads]
+        self.tmp_downloads = tmp_downloads + [(url, filename)]
+        return url
+
     # 2. Web form handling
     def _handle_form(self, response):
         """Execute handle form functions with form response."""
@@ -377,9 +465,15 @@ class DownloadBtnMixin(ModelIdBase):
         """Create files for download
 
         This method executes the CreateFiles functions before sending a 
-        'download_ready' message.
-
-        Progress reports are yielded as server sent events.
+        'download_ready' message. If the manager's `max_memory` is exceeded, 
+        a 'create_error' message is sent instead.
+
+        Progress reports are yielded as server sent events. If the manager's 
+        `release_db_connections` is `True`, the session is closed while each 
+        event is sent, returning its connection to the pool, and the button 
+        is added back to the session before the create file function 
+        resumes. Closing the session detaches other objects and rolls back 
+        changes which were flushed but not committed.
         """
         def update_transition_speed():
             """Update transition speed of progress bar
@@ -406,15 +500,39 @@ class DownloadBtnMixin(ModelIdBase):
             })
             return 'event: download_ready\ndata: {}\n\n'.format(data)
 
+        manager = app.extensions['download_btn_manager']
+        session = manager.db.session
+        release = manager.release_db_connections
+        profiler = None
+        if manager.profile or manager.max_memory is not None:
+            profiler = JobProfiler(manager.profile, manager.max_memory)
         with app.app_context():
-            app.extensions['download_btn_manager'].db.session.add(self)
+            session.add(self)
             sse_prev = sse_curr = datetime.now()
-            for func in self.create_file_functions:
-                for exp in func(self):
-                    yield exp
-                    sse_prev, sse_curr = sse_curr, datetime.now()
-                    yield update_transition_speed()
-            download_ready_event = download_ready()
+            try:
+                for func in list(self.create_file_functions):
+                    events = (
+                        func(self) if profiler is None 
+                        else profiler.run(func, self)
+                    )
+                    for exp in events:
+                        if release:
+                            # return the connection to the pool while the 
+                            # client processes the event
+                            session.close()
+                        yield exp
+                        sse_prev, sse_curr = sse_curr, datetime.now()
+                        yield update_transition_speed()
+                        if release:
+                            session.add(self)
+                last_event = download_ready()
+            except MemoryLimitError as e:
+                last_event = self.error(str(e))
+            finally:
+                if release:
+                    session.add(self)
+                if profiler is not None:
+                    manager._store_profile(self, profiler)
         # need to exit the app context before the last yield
         # otherwise you get hanging connection to database
-        yield download_ready_event
\ No newline at end of file
+        yield last_event
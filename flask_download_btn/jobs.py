@@ -0,0 +1,221 @@
+"""# Background file creation jobs"""
+
+import json
+import queue
+import threading
+import time
+
+# seconds between keep-alive comments on a channel stream
+KEEP_ALIVE = 15
+
+
+class CreateFilesJob():
+    """
+    Runs a download button's `create_file_functions` in a background thread
+    and buffers the server sent events they yield. Clients attach to the job
+    by iterating over `stream()`, which replays buffered events and then
+    follows the job until it finishes.
+
+    Parameters
+    ----------
+    app : flask.app.Flask
+        Application with which the download button is associated.
+
+    btn_cls : class
+        Class of the download button.
+
+    id :
+        Identity of the download button.
+
+    Attributes
+    ----------
+    events : list of str
+        Server sent events yielded so far.
+
+    done : bool
+        Indicates that the job has finished.
+
+    cancelled : bool
+        Indicates that the job was cancelled before it finished.
+
+    created : float
+        Time at which the job was created.
+    """
+    def __init__(self, app, btn_cls, id):
+        self.app = app
+        self.btn_cls = btn_cls
+        self.id = id
+        self.events = []
+        self.done = False
+        self.cancelled = False
+        self.created = time.time()
+        self._listeners = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """
+        Start the job.
+
+        Returns
+        -------
+        self : CreateFilesJob
+        """
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """
+        Cancel the job. The job stops before the create file functions 
+        take their next step. A step which is already running, i.e. the 
+        code between two yielded events, cannot be interrupted and runs to 
+        completion.
+        """
+        self.cancelled = True
+
+    def _run(self):
+        """Create files and buffer the events"""
+        try:
+            with self.app.app_context():
+                btn = self.btn_cls.query.get(self.id)
+                events = btn._create_files(self.app)
+                try:
+                    # check for cancellation before resuming the create 
+                    # file functions, not after their next step
+                    while not self.cancelled:
+                        try:
+                            event = next(events)
+                        except StopIteration:
+                            break
+                        self._append(event)
+                finally:
+                    events.close()
+        except Exception:
+            self.app.logger.exception(
+                'Background file creation failed for {} {}'.format(
+                    self.btn_cls.__name__, self.id
+                )
+            )
+            data = json.dumps({'text': 'File creation failed'})
+            self._append('event: create_error\ndata: {}\n\n'.format(data))
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    def _append(self, event):
+        with self._cond:
+            self.events.append(event)
+            [listener(event) for listener in self._listeners]
+            self._cond.notify_all()
+
+    def subscribe(self, listener):
+        """
+        Call `listener` with every event the job has yielded and will yield.
+
+        Parameters
+        ----------
+        listener : callable
+            Function which takes a server sent event.
+        """
+        with self._cond:
+            [listener(event) for event in self.events]
+            self._listeners.append(listener)
+
+    def stream(self):
+        """
+        Yields the job's server sent events, waiting for new events until
+        the job is done.
+        """
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self.events) and not self.done:
+                    self._cond.wait()
+                events, done = self.events[i:], self.done
+            i += len(events)
+            for event in events:
+                yield event
+            if done and i >= len(self.events):
+                return
+
+
+def tag_event(event, btn_id):
+    """
+    Tag a server sent event with the id of the button which produced it. 
+    The event's data becomes `{"btn": btn_id, "data": data}`.
+
+    Parameters
+    ----------
+    event : str
+        Server sent event.
+
+    btn_id : str
+        Model id of the download button.
+
+    Returns
+    -------
+    tagged event : str
+    """
+    name, data = 'message', []
+    for line in event.splitlines():
+        if line.startswith('event:'):
+            name = line[len('event:'):].strip()
+        elif line.startswith('data:'):
+            data.append(line[len('data:'):].lstrip())
+    data = '\n'.join(data)
+    try:
+        data = json.loads(data)
+    except ValueError:
+        pass
+    data = json.dumps({'btn': btn_id, 'data': data})
+    return 'event: {}\ndata: {}\n\n'.format(name, data)
+
+
+class Channel():
+    """
+    Page-level channel carrying the events of every download button on the 
+    page over a single server sent event stream.
+
+    Attributes
+    ----------
+    connected : bool
+        Indicates that a client is reading the channel's stream.
+
+    last_active : float
+        Time at which the channel was created or last disconnected.
+    """
+    def __init__(self):
+        self.connected = False
+        self.last_active = time.time()
+        self._queue = queue.Queue()
+
+    def add(self, job, btn_id):
+        """
+        Forward a job's events to the channel, tagged with the button id.
+
+        Parameters
+        ----------
+        job : CreateFilesJob
+            File creation job.
+
+        btn_id : str
+            Model id of the download button.
+        """
+        job.subscribe(lambda event: self._queue.put(tag_event(event, btn_id)))
+
+    def stream(self):
+        """
+        Yields tagged events as they arrive, with periodic keep-alive 
+        comments.
+        """
+        self.connected = True
+        try:
+            while True:
+                try:
+                    yield self._queue.get(timeout=KEEP_ALIVE)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+        finally:
+            self.connected = False
+            self.last_active = time.time()
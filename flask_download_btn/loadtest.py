@@ -0,0 +1,344 @@
+"""# Load testing
+
+Simulates many clients clicking download buttons at once against a local
+server. Each client requests a page with a download button, then calls the
+button's form handling, file creation, and downloaded routes, exactly as the
+download button script does.
+
+Run from the command line:
+
+```
+$ python -m flask_download_btn.loadtest --clients 200 --events 20
+```
+"""
+
+from . import DownloadBtnManager, DownloadBtnMixin
+
+from flask import Flask, render_template_string
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy_mutable import partial
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from urllib.request import HTTPCookieProcessor, build_opener
+import argparse
+import html
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PAGE_TEMPLATE = "{{ btn.render_script() | safe }}"
+URL_RE = re.compile(r'"(/download-btn/[^"]+)"')
+
+
+def synthetic_create(btn, n_events=10, delay=.01, size=1024):
+    """
+    Synthetic create file function.
+
+    Parameters
+    ----------
+    btn : DownloadBtnMixin
+        Download button.
+
+    n_events : int, default=10
+        Number of progress reports to yield.
+
+    delay : float, default=.01
+        Seconds to sleep before each progress report.
+
+    size : int, default=1024
+        Size of the created file in bytes. The file is served as a data URL.
+    """
+    stage = 'Creating file'
+    yield btn.reset(stage, 0)
+    for i in range(n_events):
+        time.sleep(delay)
+        yield btn.report(stage, 100.0*(i+1)/n_events)
+    data = b64encode(os.urandom(size)).decode()
+    btn.tmp_downloads = ('data:text/plain;base64,'+data, 'loadtest.txt')
+
+
+def build_app(database_uri, **create_kwargs):
+    """
+    Build a Flask application with a download button manager and a
+    `LoadTestBtn` model. The index route creates a button whose create file
+    function is `synthetic_create` and renders its script.
+
+    Parameters
+    ----------
+    database_uri : str
+        SQLAlchemy database URI.
+
+    \*\*create_kwargs :
+        Keyword arguments for `synthetic_create`. `prefetch` is passed to
+        the button instead.
+
+    Returns
+    -------
+    app : flask.app.Flask
+    """
+    prefetch = create_kwargs.pop('prefetch', None)
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.urandom(16)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db = SQLAlchemy(app)
+    DownloadBtnManager(app, db=db)
+
+    @DownloadBtnManager.register
+    class LoadTestBtn(DownloadBtnMixin, db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    @app.route('/')
+    def index():
+        btn = LoadTestBtn(prefetch=prefetch)
+        btn.create_file_functions = [
+            partial(synthetic_create, **create_kwargs)
+        ]
+        db.session.add(btn)
+        db.session.commit()
+        return render_template_string(PAGE_TEMPLATE, btn=btn)
+
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler which does not log every request"""
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(database_uri=None, host='127.0.0.1', **create_kwargs):
+    """
+    Serve the load test application until standard input is closed.
+
+    This runs in the server subprocess started by `run`. It writes the 
+    server's port to standard output, and when standard input is closed, 
+    writes the server's peak resident set size in KB as JSON.
+
+    Parameters
+    ----------
+    database_uri : str or None, default=None
+        SQLAlchemy database URI. If `None`, a temporary sqlite file is used 
+        and removed when the server stops.
+
+    host : str, default='127.0.0.1'
+        Host on which the server listens.
+
+    \*\*create_kwargs :
+        Keyword arguments for `build_app`.
+    """
+    path = None
+    if database_uri is None:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        database_uri = 'sqlite:///'+path
+    try:
+        app = build_app(database_uri, **create_kwargs)
+        server = make_server(
+            host, 0, app, threaded=True, request_handler=QuietRequestHandler
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(server.server_port, flush=True)
+        sys.stdin.read()
+        server.shutdown()
+    finally:
+        if path is not None:
+            os.remove(path)
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'peak_rss_kb': peak_rss_kb}), flush=True)
+
+
+def simulate_client(base_url, barrier=None):
+    """
+    Simulate one client clicking a download button.
+
+    Parameters
+    ----------
+    base_url : str
+        URL of the server, e.g. 'http://127.0.0.1:5000'.
+
+    barrier : threading.Barrier or None, default=None
+        If given, the client waits at the barrier after loading the page so
+        that all clients click at the same time.
+
+    Returns
+    -------
+    result : dict
+        Seconds from click to the first event (`first_event`) and to the
+        `download_ready` event (`download_ready`), and the number of events
+        received (`events`).
+    """
+    opener = build_opener(HTTPCookieProcessor(CookieJar()))
+    try:
+        page = opener.open(base_url+'/').read().decode()
+        form_url, create_url, downloaded_url = [
+            base_url+html.unescape(url) for url in URL_RE.findall(page)[:3]
+        ]
+    except Exception:
+        # release the other clients rather than leave them at the barrier
+        if barrier is not None:
+            barrier.abort()
+        raise
+    if barrier is not None:
+        barrier.wait()
+    start = time.perf_counter()
+    opener.open(form_url, data=b'').read()
+    result = {'first_event': None, 'download_ready': None, 'events': 0}
+    with opener.open(create_url) as stream:
+        for line in stream:
+            if not line.startswith(b'event:'):
+                continue
+            result['events'] += 1
+            if result['first_event'] is None:
+                result['first_event'] = time.perf_counter() - start
+            if line.strip() == b'event: download_ready':
+                result['download_ready'] = time.perf_counter() - start
+                break
+    opener.open(downloaded_url, data=b'').read()
+    return result
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a list of numbers"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(pct/100.0*len(values)+.5))-1, 0)
+    return values[min(rank, len(values)-1)]
+
+
+def run(
+        clients=100, n_events=10, delay=.01, size=1024, prefetch=None,
+        database_uri=None, host='127.0.0.1'
+    ):
+    """
+    Run a load test against a local server. The server runs in a 
+    subprocess; the clients run in threads of this process.
+
+    Parameters
+    ----------
+    clients : int, default=100
+        Number of concurrent clients.
+
+    n_events, delay, size :
+        Parameters of `synthetic_create`.
+
+    prefetch : str or None, default=None
+        Prefetch setting of the download buttons.
+
+    database_uri : str or None, default=None
+        SQLAlchemy database URI. If `None`, a temporary sqlite file is used 
+        and removed when the load test finishes.
+
+    host : str, default='127.0.0.1'
+        Host on which the local server listens.
+
+    Returns
+    -------
+    report : dict
+        p50 and p99 seconds to the first event and to `download_ready`,
+        events per second, number of failed clients, and peak resident set
+        size of the server in KB. The server runs in a subprocess, so its 
+        memory excludes the simulated clients.
+    """
+    cmd = [
+        sys.executable, '-m', 'flask_download_btn.loadtest', '--serve',
+        '--events', str(n_events), '--delay', str(delay),
+        '--size', str(size), '--host', host
+    ]
+    if prefetch is not None:
+        cmd += ['--prefetch', prefetch]
+    if database_uri is not None:
+        cmd += ['--database-uri', database_uri]
+    # the subprocess must import this package from the same location
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    server = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, 
+        universal_newlines=True
+    )
+    results, failures = [], 0
+    try:
+        base_url = 'http://{}:{}'.format(
+            host, int(server.stdout.readline())
+        )
+        barrier = threading.Barrier(clients)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            futures = [
+                executor.submit(simulate_client, base_url, barrier)
+                for i in range(clients)
+            ]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception:
+                    failures += 1
+        elapsed = time.perf_counter() - start
+        # closing stdin stops the server, which then reports its memory
+        server_report = json.loads(server.communicate()[0])
+    finally:
+        if server.poll() is None:
+            # let the server stop cleanly and remove its temporary database
+            try:
+                server.communicate(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+    first_event = [
+        r['first_event'] for r in results if r['first_event'] is not None
+    ]
+    download_ready = [
+        r['download_ready'] for r in results
+        if r['download_ready'] is not None
+    ]
+    return {
+        'clients': clients,
+        'failures': failures,
+        'p50_first_event': percentile(first_event, 50),
+        'p99_first_event': percentile(first_event, 99),
+        'p50_download_ready': percentile(download_ready, 50),
+        'p99_download_ready': percentile(download_ready, 99),
+        'events_per_second': sum(r['events'] for r in results) / elapsed,
+        'server_peak_rss_kb': server_report['peak_rss_kb'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test download button routes on a local server.'
+    )
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--events', type=int, default=10)
+    parser.add_argument('--delay', type=float, default=.01)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--prefetch', choices=['render'], default=None)
+    parser.add_argument('--database-uri', default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.serve:
+        return serve(
+            args.database_uri, host=args.host, n_events=args.events,
+            delay=args.delay, size=args.size, prefetch=args.prefetch
+        )
+    report = run(
+        clients=args.clients, n_events=args.events, delay=args.delay,
+        size=args.size, prefetch=args.prefetch,
+        database_uri=args.database_uri, host=args.host
+    )
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""# Profiling file creation
+
+`tracemalloc` cannot attribute allocations to threads, so memory is 
+measured for the process as a whole. When several jobs run at once, each 
+job's peak memory is the peak of the whole process while the job ran, and 
+`max_memory` is a ceiling on the whole process's traced memory. Whichever 
+job observes the ceiling being exceeded is aborted, even if another job 
+made the allocations.
+
+Only one create file function is profiled with `cProfile` at a time. On 
+Python 3.12 and later, `cProfile` is built on `sys.monitoring` and a 
+profiler is active for the whole process, so a second profiler cannot be 
+enabled while another is running. Functions which start while another 
+function is being profiled run without `cProfile`, and their reports have 
+no statistics.
+"""
+
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+
+# maps active jobs to the peak traced memory observed while they run
+_peaks = {}
+_tracing_lock = threading.Lock()
+# held by the job whose create file function is running under cProfile
+_profile_lock = threading.Lock()
+# indicates that tracemalloc was started here, rather than by the app
+_started_tracing = False
+
+
+class MemoryLimitError(MemoryError):
+    pass
+
+
+def _start_tracing(key):
+    global _started_tracing
+    with _tracing_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _peaks[key] = tracemalloc.get_traced_memory()[0]
+
+
+def _stop_tracing(key):
+    global _started_tracing
+    with _tracing_lock:
+        _peaks.pop(key, None)
+        if not _peaks and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def _sample(key):
+    """
+    Sample the process's traced memory and return the peak observed while 
+    the job `key` has been running.
+
+    The tracemalloc peak is reset after each sample, and every sample is 
+    credited to all active jobs, so resets by one job do not hide peaks 
+    from the others.
+    """
+    with _tracing_lock:
+        current, peak = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            # without reset_peak, the peak covers the whole trace
+            peak = current
+        for active in _peaks:
+            _peaks[active] = max(_peaks[active], peak)
+        return _peaks[key]
+
+
+class JobProfiler():
+    """
+    Profiles the create file functions of a file creation job.
+
+    Parameters
+    ----------
+    profile : bool, default=True
+        Indicates that each create file function runs under `cProfile`. 
+        Only one function runs under `cProfile` at a time; see the module 
+        notes.
+
+    max_memory : int or None, default=None
+        Ceiling in bytes on the process's traced memory. The peak is checked 
+        each time a create file function yields an event. If it is exceeded, 
+        the function is closed and `MemoryLimitError` is raised.
+
+    n_stats : int, default=20
+        Number of functions to include in each profile's statistics.
+
+    Attributes
+    ----------
+    reports : list of dict
+        Report for each create file function which has run. Reports contain
+        the function name (`function`), wall time in seconds (`seconds`),
+        peak traced memory of the process in bytes while the function ran 
+        (`peak_memory`), and `cProfile`
+        statistics sorted by cumulative time (`stats`, or `None` if
+        `profile` is `False`). If another function was being profiled when 
+        the function started, `stats` is `None` and the report contains a 
+        `note` explaining why.
+    """
+    def __init__(self, profile=True, max_memory=None, n_stats=20):
+        self.profile = profile
+        self.max_memory = max_memory
+        self.n_stats = n_stats
+        self.reports = []
+
+    def run(self, func, btn):
+        """
+        Run a create file function, yielding its events.
+
+        Parameters
+        ----------
+        func : callable
+            Create file function.
+
+        btn : DownloadBtnMixin
+            Download button passed to the create file function.
+        """
+        name = getattr(func, '__name__', None) or repr(func)
+        report = {'function': name, 'peak_memory': 0, 'stats': None}
+        self.reports.append(report)
+        profiler = None
+        if self.profile:
+            if _profile_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+            else:
+                report['note'] = (
+                    'cProfile skipped: another function was being profiled'
+                )
+        key = object()
+        _start_tracing(key)
+        start = time.perf_counter()
+        try:
+            events = iter(func(btn))
+            while True:
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    event = next(events)
+                except StopIteration:
+                    break
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+                    report['peak_memory'] = _sample(key)
+                if (
+                    self.max_memory is not None
+                    and report['peak_memory'] > self.max_memory
+                ):
+                    if hasattr(events, 'close'):
+                        events.close()
+                    raise MemoryLimitError(
+                        '{} exceeded the memory limit of {} bytes'.format(
+                            name, self.max_memory
+                        )
+                    )
+                yield event
+        finally:
+            _stop_tracing(key)
+            report['seconds'] = time.perf_counter() - start
+            if profiler is not None:
+                _profile_lock.release()
+                stream = io.StringIO()
+                pstats.Stats(profiler, stream=stream).sort_stats(
+                    'cumulative'
+                ).print_stats(self.n_stats)
+                report['stats'] = stream.getvalue()
+
+    def format_report(self):
+        """
+        Returns
+        -------
+        report : str
+            Human readable report of the profiled functions.
+        """
+        lines = []
+        for report in self.reports:
+            lines.append('{}: {:.3f}s, peak memory {} bytes'.format(
+                report['function'],
+                report.get('seconds', 0),
+                report['peak_memory']
+            ))
+            if report.get('note'):
+                lines.append(report['note'])
+            if report['stats']:
+                lines.append(report['stats'])
+        return '\n'.join(lines)
@@ -0,0 +1,143 @@
+"""# Storage backends
+
+Storage backends hold files created by `create_file_functions`. Files in
+storage are served through the download button manager's `download_file`
+route, which can hand the transfer off to the front-end web server. Files 
+are deleted once their signed URLs expire.
+"""
+
+import os
+import re
+import shutil
+import time
+import uuid
+
+# keys created by `LocalStorage.save`: a uuid4 hex and the file's extension
+KEY_RE = re.compile(r'^[0-9a-f]{32}(\.[^/\\]*)?$')
+
+
+class Storage():
+    """
+    Base class for storage backends. Subclasses must implement `save`,
+    `path`, and `delete`, and may implement `clean`.
+    """
+    def save(self, data, filename):
+        """
+        Save a file.
+
+        Parameters
+        ----------
+        data : bytes, str, or file-like
+            File contents. Strings are encoded as utf-8.
+
+        filename : str
+            Name of the file. Backends may use the extension when choosing
+            a key.
+
+        Returns
+        -------
+        key : str
+            Key identifying the file in storage.
+        """
+        raise NotImplementedError()
+
+    def path(self, key):
+        """
+        Parameters
+        ----------
+        key : str
+            Key identifying the file in storage.
+
+        Returns
+        -------
+        path : str
+            Absolute path to the file on the local file system.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """
+        Delete a file.
+
+        Parameters
+        ----------
+        key : str
+            Key identifying the file in storage.
+        """
+        raise NotImplementedError()
+
+    def clean(self, max_age):
+        """
+        Delete files older than `max_age`. The download button manager calls 
+        this with its `url_expires` when files are stored. The default 
+        implementation does nothing.
+
+        Parameters
+        ----------
+        max_age : float
+            Maximum age of files in seconds.
+        """
+        pass
+
+
+class LocalStorage(Storage):
+    """
+    Stores files in a local directory. `clean` only deletes regular files 
+    whose names are storage keys, so other files in the directory are left 
+    alone.
+
+    Parameters
+    ----------
+    directory : str
+        Directory in which files are stored. It is created if it does not
+        exist. When serving with `X-Accel-Redirect`, this directory should
+        be the root of the manager's `sendfile_prefix` internal location.
+
+    Examples
+    --------
+    ```python
+    from flask_download_btn.storage import LocalStorage
+
+    download_btn_manager = DownloadBtnManager(
+    \    app, db=db, storage=LocalStorage('/var/www/downloads')
+    )
+    ```
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def save(self, data, filename):
+        key = uuid.uuid4().hex + os.path.splitext(filename)[1]
+        if isinstance(data, str):
+            data = data.encode()
+        with open(self.path(key), 'wb') as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+        return key
+
+    def path(self, key):
+        if os.path.basename(key) != key:
+            raise ValueError('Invalid storage key {}'.format(key))
+        return os.path.join(self.directory, key)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def clean(self, max_age):
+        cutoff = time.time() - max_age
+        for key in os.listdir(self.directory):
+            if not KEY_RE.match(key):
+                continue
+            path = self.path(key)
+            try:
+                if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                # e.g. deleted by a concurrent clean, or permission denied
+                pass